@@ -22,7 +22,14 @@ DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{encoded_password}@{DB_HOST}:{DB
 # --- Настройка SQLAlchemy ---
 
 # Создаем асинхронный "движок" для взаимодействия с БД
-engine = create_async_engine(DATABASE_URL, echo=True) # echo=True для отладки SQL-запросов
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=True,  # echo=True для отладки SQL-запросов
+    # Пул соединений рассчитан на всплески одновременных нажатий кнопок
+    pool_size=25,
+    max_overflow=25,
+    pool_pre_ping=True,
+)
 
 # Создаем фабрику для асинхронных сессий
 async_session_maker = async_sessionmaker(
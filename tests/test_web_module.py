@@ -0,0 +1,258 @@
+import asyncio
+import socket
+import time
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+
+import web_module
+
+
+async def _generate_code(handler):
+    """
+    Поднимает локальный сервер с указанным обработчиком generate-code
+    и выполняет generate_code_from_api против него.
+    """
+    app = web.Application()
+    app.router.add_post("/api/bot/generate-code", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    endpoint = f"http://127.0.0.1:{port}/api/bot/generate-code"
+    try:
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(web_module, "_GENERATE_CODE_ENDPOINT", endpoint)
+            mp.setattr(web_module, "_API_HEADERS", {
+                'X-API-Key': 'test-secret',
+                'Content-Type': 'application/json'
+            })
+            mp.setattr(web_module, "_BREAKER", web_module._CircuitBreaker())
+            return await web_module.generate_code_from_api({'telegramId': 1})
+    finally:
+        if web_module._SESSION is not None:
+            await web_module._SESSION.close()
+            web_module._SESSION = None
+        await runner.cleanup()
+
+
+def test_json_success_is_returned():
+    async def handler(request):
+        return web.json_response({'code': 'ABC123', 'expiresAt': '2025-11-05T13:00:00.000Z'})
+
+    result = asyncio.run(_generate_code(handler))
+    assert result == {'code': 'ABC123', 'expiresAt': '2025-11-05T13:00:00.000Z'}
+
+
+@pytest.mark.parametrize("response", [
+    lambda: web.Response(status=204),
+    lambda: web.Response(status=200, text="<html>502</html>", content_type="text/html"),
+    lambda: web.json_response([1, 2]),
+], ids=["204-empty", "200-html", "200-json-list"])
+def test_invalid_success_body_is_an_api_error(response):
+    async def handler(request):
+        return response()
+
+    result = asyncio.run(_generate_code(handler))
+    assert result['error'] == 'Неизвестная ошибка'
+    assert 200 <= result['status'] < 300
+
+
+def test_error_status_reads_error_field():
+    async def handler(request):
+        return web.json_response({'error': 'Неверный ключ'}, status=401)
+
+    result = asyncio.run(_generate_code(handler))
+    assert result == {'error': 'Неверный ключ', 'status': 401}
+
+
+def test_redirect_is_not_followed():
+    seen = []
+
+    async def run():
+        async def other_host(request):
+            seen.append(request.headers.get('X-API-Key'))
+            return web.json_response({'code': 'LEAKED'})
+
+        app = web.Application()
+        app.router.add_post("/api/bot/generate-code", other_host)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "localhost", 0).start()
+        target = f"http://localhost:{runner.addresses[0][1]}/api/bot/generate-code"
+
+        async def handler(request):
+            raise web.HTTPTemporaryRedirect(target)
+
+        try:
+            return await _generate_code(handler)
+        finally:
+            await runner.cleanup()
+
+    result = asyncio.run(run())
+    assert result['status'] == 307
+    assert seen == []
+
+
+def _closed_port_endpoint():
+    """
+    Адрес, на котором гарантированно никто не слушает — соединение будет отклонено.
+    """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return f"http://127.0.0.1:{port}/api/bot/generate-code"
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """
+    Чистое состояние предохранителя, ограничителя и сессии для одного теста.
+    Возвращает список, в который записывается каждый вызов _request_code.
+    """
+    calls = []
+    request_code = web_module._request_code
+
+    async def counting_request_code(user_data):
+        calls.append(user_data)
+        return await request_code(user_data)
+
+    monkeypatch.setattr(web_module, "_request_code", counting_request_code)
+    monkeypatch.setattr(web_module, "_BREAKER", web_module._CircuitBreaker())
+    monkeypatch.setattr(web_module, "_BULKHEAD", asyncio.Semaphore(16))
+    monkeypatch.setattr(web_module, "_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(web_module, "_API_HEADERS", {'X-API-Key': 'test-secret'})
+    monkeypatch.setattr(web_module, "_SESSION", None)
+    return calls
+
+
+async def _call_api():
+    try:
+        return await web_module.generate_code_from_api({'telegramId': 1})
+    finally:
+        if web_module._SESSION is not None:
+            await web_module._SESSION.close()
+            web_module._SESSION = None
+
+
+def _expire_open_breaker():
+    breaker = web_module._BREAKER
+    breaker.state = 'open'
+    breaker.opened_at = time.monotonic() - breaker.reset_timeout
+
+
+def test_connector_error_is_retried(api, monkeypatch):
+    monkeypatch.setattr(web_module, "_GENERATE_CODE_ENDPOINT", _closed_port_endpoint())
+
+    result = asyncio.run(_call_api())
+    assert result == {'error': 'connection_failed'}
+    assert len(api) == web_module._MAX_ATTEMPTS
+    assert web_module._BREAKER.failures == web_module._MAX_ATTEMPTS
+
+
+def test_server_disconnect_is_not_retried(api):
+    async def handler(request):
+        request.transport.close()
+        return web.Response()
+
+    result = asyncio.run(_generate_code(handler))
+    assert result == {'error': 'connection_failed'}
+    assert len(api) == 1
+
+
+def test_breaker_opens_and_short_circuits(api, monkeypatch):
+    monkeypatch.setattr(web_module, "_GENERATE_CODE_ENDPOINT", _closed_port_endpoint())
+
+    asyncio.run(_call_api())
+    asyncio.run(_call_api())
+    assert web_module._BREAKER.state == 'open'
+
+    api.clear()
+    result = asyncio.run(_call_api())
+    assert result == {'error': 'connection_failed'}
+    assert api == []
+
+
+def test_full_bulkhead_does_not_consume_probe(api, monkeypatch):
+    monkeypatch.setattr(web_module, "_BULKHEAD", asyncio.Semaphore(0))
+    monkeypatch.setattr(web_module, "_BULKHEAD_WAIT", 0.01)
+    _expire_open_breaker()
+
+    result = asyncio.run(_call_api())
+    assert result == {'error': 'busy'}
+    assert web_module._BREAKER.state == 'open'
+    assert web_module._BREAKER.allow_request()
+
+
+def test_unexpected_error_releases_probe(api, monkeypatch):
+    async def broken_request_code(user_data):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(web_module, "_request_code", broken_request_code)
+    _expire_open_breaker()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(_call_api())
+    assert web_module._BREAKER.state == 'open'
+    assert web_module._BREAKER.allow_request()
+
+
+def test_error_body_split_across_chunks_is_read_whole():
+    async def handler(request):
+        body = '{"error": "Неверный ключ"}'.encode()
+        response = web.StreamResponse(status=401)
+        response.content_type = 'application/json'
+        await response.prepare(request)
+        await response.write(body[:5])
+        await asyncio.sleep(0.05)
+        await response.write(body[5:])
+        await response.write_eof()
+        return response
+
+    result = asyncio.run(_generate_code(handler))
+    assert result == {'error': 'Неверный ключ', 'status': 401}
+
+
+def test_regenerate_clicks_within_cooldown_do_not_mint_codes(monkeypatch):
+    delivered = []
+    answers = []
+
+    async def fake_deliver_code(send_fn, user, title):
+        delivered.append(user.id)
+
+    async def answer(text=None):
+        answers.append(text)
+
+    async def edit_message_text(*args, **kwargs):
+        pass
+
+    async def run_click():
+        update = SimpleNamespace(
+            callback_query=SimpleNamespace(answer=answer, edit_message_text=edit_message_text),
+            effective_user=SimpleNamespace(id=42)
+        )
+        pending = []
+        context = SimpleNamespace(application=SimpleNamespace(
+            create_task=lambda coro, update=None: pending.append(coro)
+        ))
+        await web_module.web_regenerate_callback(update, context)
+        for coro in pending:
+            await coro
+
+    monkeypatch.setattr(web_module, "_deliver_code", fake_deliver_code)
+    monkeypatch.setattr(web_module, "_LAST_REGENERATE", {})
+
+    # Обновления приходят по очереди, как при concurrent_updates=1
+    asyncio.run(run_click())
+    asyncio.run(run_click())
+    assert delivered == [42]
+    assert answers[0] is None
+    assert answers[1].startswith("⏳")
+
+    web_module._LAST_REGENERATE[42] -= web_module._REGENERATE_COOLDOWN
+    asyncio.run(run_click())
+    assert delivered == [42, 42]
@@ -4,24 +4,247 @@
 Позволяет пользователям генерировать коды для входа на сайт.
 """
 
+import asyncio
+import json
 import logging
+import math
 import os
+import random
+import re
+import time
 import aiohttp
 from datetime import datetime
+from functools import lru_cache
+from typing import Awaitable, Callable
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import CommandHandler, CallbackQueryHandler, ContextTypes
-from sqlalchemy import select
+from sqlalchemy import select, bindparam
 from database import async_session_maker
 from models import User
 
 logger = logging.getLogger(__name__)
 
+# orjson заметно быстрее стандартного json; если он не установлен — работаем без него
+try:
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
 # Конфигурация из переменных окружения
 WEBSITE_URL = os.getenv("WEBSITE_URL", "http://localhost:5000")
+_GENERATE_CODE_ENDPOINT = f"{WEBSITE_URL}/api/bot/generate-code"
 API_SECRET = os.getenv("TELEGRAM_BOT_API_SECRET")
 
-if not API_SECRET:
-    logger.error("TELEGRAM_BOT_API_SECRET environment variable is not set!")
+# Запрос пользователя строится один раз — SQLAlchemy берёт его из кэша компиляции.
+# Выбираются только поля, которые отправляются на сайт, без загрузки ORM-объекта
+_STMT_USER_BY_TG_ID = select(
+    User.telegram_id,
+    User.nickname,
+    User.username,
+    User.quote,
+    User.bot_id
+).where(User.telegram_id == bindparam('tg_id'))
+
+# Шаблоны callback-данных компилируются один раз при импорте
+_WEB_REGENERATE_RE = re.compile(r"^web_regenerate$")
+
+# Клавиатура и текст сообщения с кодом одинаковы для всех — собираем их один раз
+_REPLY_MARKUP = InlineKeyboardMarkup((
+    (InlineKeyboardButton("🌐 Открыть сайт", url=WEBSITE_URL),),
+    (InlineKeyboardButton("🔄 Новый код", callback_data="web_regenerate"),),
+))
+
+_MSG_TEMPLATE = (
+    "🌐 <b>{title}</b>\n\n"
+    "🔑 Ваш код: <code>{code}</code>\n\n"
+    "⏰ Действителен до: {expires}\n\n"
+    "📝 Инструкция:\n"
+    "1. Перейдите на сайт WIRALIS\n"
+    "2. Нажмите кнопку 'Жду Сайт'\n"
+    "3. Введите код выше\n"
+    "4. Наслаждайтесь своим профилем!\n\n"
+    "💡 Код можно использовать только один раз."
+)
+
+# Параметры запросов к API сайта
+_API_TIMEOUT = aiohttp.ClientTimeout(total=10)
+_WARMUP_TIMEOUT = aiohttp.ClientTimeout(total=2)
+_API_HEADERS = {
+    'X-API-Key': API_SECRET,
+    'Content-Type': 'application/json'
+}
+
+# Общая HTTP-сессия модуля: держит keep-alive соединения с сайтом между запросами
+_SESSION: aiohttp.ClientSession | None = None
+
+# Фоновые задачи модуля (закрытие сессии), на которые нужно держать ссылку
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    """
+    Возвращает общую HTTP-сессию, создавая её при первом обращении.
+    """
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=32,
+                limit_per_host=16,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            ),
+            timeout=_API_TIMEOUT,
+            json_serialize=_json_dumps
+        )
+    return _SESSION
+
+
+# Было ли уже открыто соединение с сайтом после старта процесса
+_UPSTREAM_WARMED = False
+
+
+async def _ensure_upstream_connected():
+    """
+    Прогревает пул соединений с сайтом (DNS, TCP и TLS) при первом обращении,
+    чтобы это происходило параллельно с запросом в базу данных.
+    Ошибки игнорируются — настоящий запрос обработает их сам.
+    """
+    global _UPSTREAM_WARMED
+    if _UPSTREAM_WARMED or _BREAKER.state != 'closed':
+        return
+    _UPSTREAM_WARMED = True
+
+    session = await _get_session()
+    try:
+        async with session.head(WEBSITE_URL, timeout=_WARMUP_TIMEOUT):
+            pass
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logger.debug("Upstream warm-up failed: %s", e)
+
+
+# Кэш данных пользователя для API сайта: telegram_id -> (момент истечения, данные)
+_USER_CACHE: dict[int, tuple[float, dict]] = {}
+_USER_CACHE_TTL = 60
+_USER_CACHE_MAX_SIZE = 10_000
+
+
+def invalidate_user_payload(tg_id: int):
+    """
+    Сбрасывает кэшированные данные пользователя для сайта.
+    Вызывается модулями, которые меняют отправляемые на сайт поля
+    (nickname, username, quote, bot_id), чтобы следующий /web не ждал TTL.
+    """
+    _USER_CACHE.pop(tg_id, None)
+
+
+async def _get_user_payload(tg_id: int) -> dict | None:
+    """
+    Возвращает данные пользователя для отправки на сайт.
+
+    Результат кэшируется на _USER_CACHE_TTL секунд, чтобы повторные /web
+    и нажатия "Новый код" не ходили в базу. Незарегистрированные
+    пользователи не кэшируются.
+
+    Returns:
+        dict | None: Данные пользователя или None, если он не зарегистрирован
+    """
+    now = time.monotonic()
+    cached = _USER_CACHE.get(tg_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    async with async_session_maker() as session:
+        result = await session.execute(_STMT_USER_BY_TG_ID, {'tg_id': tg_id})
+        row = result.one_or_none()
+
+    if row is None:
+        _USER_CACHE.pop(tg_id, None)
+        return None
+
+    user_data = {
+        'telegramId': row.telegram_id,
+        'nickname': row.nickname,
+        'username': row.username,
+        'quote': row.quote,
+        'botId': row.bot_id,
+    }
+
+    if len(_USER_CACHE) >= _USER_CACHE_MAX_SIZE:
+        _USER_CACHE.clear()
+    _USER_CACHE[tg_id] = (now + _USER_CACHE_TTL, user_data)
+    return user_data
+
+
+class _CircuitBreaker:
+    """
+    Простой предохранитель для запросов к сайту.
+
+    После failure_threshold ошибок соединения подряд запросы перестают
+    отправляться на reset_timeout секунд, после чего пропускается одна
+    пробная попытка: успех закрывает предохранитель, ошибка снова его открывает.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow_request(self) -> bool:
+        if self.state == 'closed':
+            return True
+        now = time.monotonic()
+        # В полуоткрытом состоянии пробная попытка уже идёт; если она так и не
+        # завершилась за reset_timeout, разрешаем следующую
+        if now - self.opened_at >= self.reset_timeout:
+            self.state = 'half_open'
+            self.opened_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+    def abort_probe(self):
+        """
+        Пробная попытка прервалась, не выяснив состояние сайта (неожиданное
+        исключение или отмена) — разрешаем следующему вызову пробовать сразу.
+        """
+        if self.state == 'half_open':
+            self.state = 'open'
+            self.opened_at = time.monotonic() - self.reset_timeout
+
+
+_BREAKER = _CircuitBreaker()
+
+
+# Не больше запросов к сайту одновременно, чем соединений на хост в пуле сессии
+_BULKHEAD = asyncio.Semaphore(16)
+_BULKHEAD_WAIT = 0.5
+
+# Повтор запроса только если соединение не удалось установить; обрывы после
+# отправки, таймауты и ответы сайта с ошибкой не повторяются
+_MAX_ATTEMPTS = 2
+_RETRY_BASE_DELAY = 0.2
+_RETRY_MAX_DELAY = 2.0
+
+# Сколько байт тела ответа с ошибкой читать для разбора и логирования
+_ERROR_BODY_LIMIT = 512
 
 
 async def generate_code_from_api(user_data: dict) -> dict:
@@ -34,265 +257,338 @@ async def generate_code_from_api(user_data: dict) -> dict:
     Returns:
         dict: Ответ от API с кодом или ошибкой
     """
+    # Ограничиваем число одновременных запросов к сайту: при всплеске нагрузки
+    # лишние вызовы быстро получают отказ вместо долгого ожидания таймаута
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f'{WEBSITE_URL}/api/bot/generate-code',
-                json=user_data,
-                headers={
-                    'X-API-Key': API_SECRET,
-                    'Content-Type': 'application/json'
-                },
-                timeout=aiohttp.ClientTimeout(total=10)
-            ) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    error_data = await response.json()
-                    error_msg = error_data.get('error', 'Неизвестная ошибка')
-                    logger.error(f"API error: {response.status} - {error_msg}")
-                    return {'error': error_msg, 'status': response.status}
-                    
-    except aiohttp.ClientTimeout:
+        await asyncio.wait_for(_BULKHEAD.acquire(), timeout=_BULKHEAD_WAIT)
+    except asyncio.TimeoutError:
+        logger.warning("API bulkhead is full, request rejected")
+        return {'error': 'busy'}
+
+    try:
+        for attempt in range(_MAX_ATTEMPTS):
+            if attempt:
+                # Экспоненциальная задержка с полным джиттером, чтобы повторы
+                # от многих пользователей не били по сайту одновременно
+                await asyncio.sleep(
+                    random.uniform(0, min(_RETRY_BASE_DELAY * 2 ** attempt, _RETRY_MAX_DELAY))
+                )
+            # Предохранитель спрашиваем только с занятым слотом: allow_request()
+            # может выдать единственную пробную попытку, и она должна уйти на сайт
+            if not _BREAKER.allow_request():
+                logger.warning("API circuit breaker is open, request skipped")
+                break
+            try:
+                return await _request_code(user_data)
+            except aiohttp.ClientConnectorError as e:
+                # Соединение не установлено — запрос не отправлен, повтор безопасен.
+                # Ошибки соединения ожидаемы при недоступности сайта — трейсбек не нужен,
+                # остальные исключения уходят в обработчик команды
+                _BREAKER.record_failure()
+                logger.warning(
+                    "API connection error (attempt %s/%s): %s: %s",
+                    attempt + 1, _MAX_ATTEMPTS, type(e).__name__, e
+                )
+            except (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError) as e:
+                # Запрос мог уже дойти до сайта и выпустить одноразовый код —
+                # повтор выпустил бы второй, поэтому не повторяем
+                _BREAKER.record_failure()
+                logger.warning("API connection error: %s: %s", type(e).__name__, e)
+                break
+            except BaseException:
+                _BREAKER.abort_probe()
+                raise
+        return {'error': 'connection_failed'}
+    finally:
+        _BULKHEAD.release()
+
+
+async def _read_limited(response: aiohttp.ClientResponse, limit: int) -> bytes:
+    """
+    Читает тело ответа до limit байт или до его конца. Один вызов
+    content.read(n) возвращает только то, что уже пришло, и может
+    оборвать JSON посередине.
+    """
+    raw = b''
+    while len(raw) < limit:
+        chunk = await response.content.read(limit - len(raw))
+        if not chunk:
+            break
+        raw += chunk
+    return raw
+
+
+async def _request_code(user_data: dict) -> dict:
+    """
+    Выполняет один POST-запрос генерации кода к сайту.
+    Ошибки соединения не перехватываются — их повторяет generate_code_from_api.
+    """
+    try:
+        session = await _get_session()
+        # Секрет передаётся только в запросе генерации кода, а не всем запросам сессии
+        async with session.post(
+            _GENERATE_CODE_ENDPOINT,
+            json=user_data,
+            headers=_API_HEADERS,
+            # aiohttp переносит X-API-Key на новый хост при редиректе —
+            # не следуем им, 3xx обрабатывается как ошибка API
+            allow_redirects=False
+        ) as response:
+            # Сайт ответил — соединение в порядке, даже если статус не 200
+            _BREAKER.record_success()
+            try:
+                if 200 <= response.status < 300:
+                    raw = await response.read()
+                    try:
+                        result = _json_loads(raw)
+                    except ValueError:
+                        result = None
+                    # 204 без тела, HTML-страница или JSON не в виде объекта —
+                    # кода в таком ответе нет
+                    if isinstance(result, dict):
+                        return result
+                    logger.error(
+                        "API returned invalid response: %s - %s",
+                        response.status,
+                        raw[:_ERROR_BODY_LIMIT].decode('utf-8', 'replace')
+                    )
+                    return {'error': 'Неизвестная ошибка', 'status': response.status}
+
+                # Тело ошибки читаем с ограничением: на сбоях прокси могут прийти
+                # большие HTML-страницы, а нужно только поле error из JSON
+                raw = await _read_limited(response, _ERROR_BODY_LIMIT)
+            except aiohttp.ClientPayloadError as e:
+                # Ответ пришёл, но тело оборвано или повреждено — это не ошибка
+                # программы, трейсбек в обработчике команды не нужен
+                logger.error("API response body error: %s - %s", response.status, e)
+                return {'error': 'Неизвестная ошибка', 'status': response.status}
+
+            try:
+                error_msg = _json_loads(raw).get('error', 'Неизвестная ошибка')
+            except (ValueError, AttributeError):
+                error_msg = 'Неизвестная ошибка'
+            logger.error(
+                "API error: %s - %s",
+                response.status, raw.decode('utf-8', 'replace')
+            )
+            return {'error': error_msg, 'status': response.status}
+
+    except asyncio.TimeoutError:
+        _BREAKER.record_failure()
         logger.error("API request timeout")
         return {'error': 'timeout'}
-    except Exception as e:
-        logger.error(f"API request error: {e}", exc_info=True)
-        return {'error': 'connection_failed'}
 
 
-async def web_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def _format_expiry(expires_at) -> str:
     """
-    Обработчик команды /web - генерирует код для входа на сайт.
+    Преобразует время истечения кода из ответа API в строку вида ЧЧ:ММ.
     """
-    user = update.effective_user
-    
-    if not user:
-        await update.message.reply_text("❌ Не удалось определить пользователя.")
-        return
+    # lru_cache хэширует аргумент до вызова, поэтому нестроковые значения
+    # (списки, словари) отсекаем заранее
+    if not isinstance(expires_at, str):
+        return "10 минут"
+    return _format_expiry_str(expires_at)
 
-    if not API_SECRET:
-        await update.message.reply_text(
-            "❌ Система временно недоступна. Обратитесь к администратору."
+
+@lru_cache(maxsize=256)
+def _format_expiry_str(expires_at: str) -> str:
+    """
+    Разбирает строку expiresAt. Одинаковые значения повторяются в пределах
+    окна жизни кода, поэтому результат кэшируется.
+    """
+    try:
+        expires = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
+        return expires.strftime('%H:%M')
+    except (TypeError, ValueError, AttributeError):
+        return "10 минут"
+
+
+async def _deliver_code(send_fn: Callable[..., Awaitable], user, title: str):
+    """
+    Общая логика /web и кнопки "Новый код": получает данные пользователя,
+    запрашивает код у сайта и отправляет результат через send_fn.
+
+    Args:
+        send_fn: Метод отправки ответа (reply_text или edit_message_text)
+        user: Пользователь Telegram, запросивший код
+        title: Заголовок сообщения с кодом
+    """
+    # Получаем данные пользователя (из кэша или базы данных),
+    # на холодном старте параллельно открываем соединение с сайтом
+    user_data, _ = await asyncio.gather(
+        _get_user_payload(user.id),
+        _ensure_upstream_connected()
+    )
+
+    if not user_data:
+        await send_fn(
+            "❌ <b>Вы не зарегистрированы в боте!</b>\n\n"
+            "Используйте команду /start для регистрации.",
+            parse_mode='HTML'
         )
         return
 
-    try:
-        # Получаем данные пользователя из базы данных
-        async with async_session_maker() as session:
-            stmt = select(User).where(User.telegram_id == user.id)
-            result = await session.execute(stmt)
-            db_user = result.scalar_one_or_none()
-
-        if not db_user:
-            await update.message.reply_text(
-                "❌ <b>Вы не зарегистрированы в боте!</b>\n\n"
-                "Используйте команду /start для регистрации.",
+    # Отправляем асинхронный запрос на сайт для генерации кода
+    result = await generate_code_from_api(user_data)
+
+    if 'error' in result:
+        if result['error'] == 'timeout':
+            await send_fn(
+                "⏱️ Превышено время ожидания ответа от сайта.\n"
+                "Попробуйте еще раз через несколько секунд."
+            )
+        elif result['error'] == 'busy':
+            await send_fn(
+                "⏳ Система занята, слишком много запросов.\n"
+                "Попробуйте еще раз через несколько секунд."
+            )
+        elif result['error'] == 'connection_failed':
+            await send_fn(
+                "❌ Не удалось связаться с сайтом.\n"
+                "Попробуйте позже или обратитесь к администратору."
+            )
+        else:
+            await send_fn(
+                f"❌ Ошибка при генерации кода: {result['error']}\n\n"
+                "Попробуйте позже или обратитесь к администратору.",
                 parse_mode='HTML'
             )
-            return
+        return
 
-        # Формируем данные для отправки на сайт
-        user_data = {
-            'telegramId': db_user.telegram_id,
-            'nickname': db_user.nickname,
-            'username': db_user.username,
-            'quote': db_user.quote,
-            'botId': db_user.bot_id,
-        }
-
-        # Отправляем асинхронный запрос на сайт для генерации кода
-        result = await generate_code_from_api(user_data)
-
-        if 'error' in result:
-            if result['error'] == 'timeout':
-                await update.message.reply_text(
-                    "⏱️ Превышено время ожидания ответа от сайта.\n"
-                    "Попробуйте еще раз через несколько секунд."
-                )
-            elif result['error'] == 'connection_failed':
-                await update.message.reply_text(
-                    "❌ Не удалось связаться с сайтом.\n"
-                    "Попробуйте позже или обратитесь к администратору."
-                )
-            else:
-                await update.message.reply_text(
-                    f"❌ Ошибка при генерации кода: {result['error']}\n\n"
-                    "Попробуйте позже или обратитесь к администратору.",
-                    parse_mode='HTML'
-                )
-            return
+    code = result.get('code')
+    expires_at = result.get('expiresAt')
 
-        code = result.get('code')
-        expires_at = result.get('expiresAt')
-        
-        # Парсим время истечения
-        try:
-            expires = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-            expires_text = expires.strftime('%H:%M')
-        except:
-            expires_text = "10 минут"
-
-        message = (
-            f"🌐 <b>Код для входа на сайт WIRALIS</b>\n\n"
-            f"🔑 Ваш код: <code>{code}</code>\n\n"
-            f"⏰ Действителен до: {expires_text}\n\n"
-            f"📝 Инструкция:\n"
-            f"1. Перейдите на сайт WIRALIS\n"
-            f"2. Нажмите кнопку 'Жду Сайт'\n"
-            f"3. Введите код выше\n"
-            f"4. Наслаждайтесь своим профилем!\n\n"
-            f"💡 Код можно использовать только один раз."
-        )
+    expires_text = _format_expiry(expires_at)
 
-        keyboard = [
-            [InlineKeyboardButton("🌐 Открыть сайт", url=WEBSITE_URL)],
-            [InlineKeyboardButton("🔄 Новый код", callback_data="web_regenerate")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    message = _MSG_TEMPLATE.format(
+        title=title,
+        code=code,
+        expires=expires_text
+    )
 
-        await update.message.reply_text(
-            message,
-            parse_mode='HTML',
-            reply_markup=reply_markup
+    await send_fn(
+        message,
+        parse_mode='HTML',
+        reply_markup=_REPLY_MARKUP
+    )
+
+
+async def web_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Обработчик команды /web - генерирует код для входа на сайт.
+    """
+    user = update.effective_user
+    
+    if not user:
+        await update.message.reply_text("❌ Не удалось определить пользователя.")
+        return
+
+    try:
+        await _deliver_code(
+            update.message.reply_text, user, "Код для входа на сайт WIRALIS"
         )
 
     except Exception as e:
-        logger.error(f"Error in web_command: {e}", exc_info=True)
+        logger.error("Error in web_command: %s", e, exc_info=True)
         await update.message.reply_text(
             "❌ Произошла ошибка при обработке команды.\n"
             "Попробуйте позже."
         )
 
 
+# Время последнего нажатия "Новый код" по пользователям: telegram_id -> monotonic().
+# Обновления обрабатываются по очереди, поэтому повторные нажатия отсекаются
+# по времени, а не по признаку "запрос ещё выполняется"
+_LAST_REGENERATE: dict[int, float] = {}
+_REGENERATE_COOLDOWN = 10.0
+_LAST_REGENERATE_MAX_SIZE = 10_000
+
+
 async def web_regenerate_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обработчик кнопки "Новый код" - регенерирует код для пользователя.
     """
     query = update.callback_query
-    await query.answer()
-
     user = update.effective_user
+    now = time.monotonic()
+
+    # Частые нажатия не выпускают новый код на сайте каждый раз
+    if user:
+        last = _LAST_REGENERATE.get(user.id)
+        if last is not None and now - last < _REGENERATE_COOLDOWN:
+            wait = math.ceil(_REGENERATE_COOLDOWN - (now - last))
+            context.application.create_task(
+                query.answer(f"⏳ Новый код можно получить через {wait} сек."),
+                update=update
+            )
+            return
+
+    # Ответ на callback только убирает "часики" у кнопки — не ждём его,
+    # ошибки уйдут в общий обработчик ошибок приложения
+    context.application.create_task(query.answer(), update=update)
     
     if not user:
         await query.edit_message_text("❌ Не удалось определить пользователя.")
         return
 
-    if not API_SECRET:
-        await query.edit_message_text(
-            "❌ Система временно недоступна. Обратитесь к администратору."
-        )
-        return
+    if len(_LAST_REGENERATE) >= _LAST_REGENERATE_MAX_SIZE:
+        for tg_id, pressed_at in list(_LAST_REGENERATE.items()):
+            if now - pressed_at >= _REGENERATE_COOLDOWN:
+                del _LAST_REGENERATE[tg_id]
+    _LAST_REGENERATE[user.id] = now
 
     try:
-        # Получаем данные пользователя из базы данных
-        async with async_session_maker() as session:
-            stmt = select(User).where(User.telegram_id == user.id)
-            result = await session.execute(stmt)
-            db_user = result.scalar_one_or_none()
-
-        if not db_user:
-            await query.edit_message_text(
-                "❌ <b>Вы не зарегистрированы в боте!</b>\n\n"
-                "Используйте команду /start для регистрации.",
-                parse_mode='HTML'
-            )
-            return
-
-        # Формируем данные для отправки на сайт
-        user_data = {
-            'telegramId': db_user.telegram_id,
-            'nickname': db_user.nickname,
-            'username': db_user.username,
-            'quote': db_user.quote,
-            'botId': db_user.bot_id,
-        }
-
-        # Отправляем асинхронный запрос на сайт для генерации кода
-        result = await generate_code_from_api(user_data)
-
-        if 'error' in result:
-            if result['error'] == 'timeout':
-                await query.edit_message_text(
-                    "⏱️ Превышено время ожидания ответа от сайта.\n"
-                    "Попробуйте еще раз через несколько секунд."
-                )
-            elif result['error'] == 'connection_failed':
-                await query.edit_message_text(
-                    "❌ Не удалось связаться с сайтом.\n"
-                    "Попробуйте позже или обратитесь к администратору."
-                )
-            else:
-                await query.edit_message_text(
-                    f"❌ Ошибка при генерации кода: {result['error']}\n\n"
-                    "Попробуйте позже или обратитесь к администратору.",
-                    parse_mode='HTML'
-                )
-            return
-
-        code = result.get('code')
-        expires_at = result.get('expiresAt')
-        
-        # Парсим время истечения
-        try:
-            expires = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-            expires_text = expires.strftime('%H:%M')
-        except:
-            expires_text = "10 минут"
-
-        message = (
-            f"🌐 <b>Новый код для входа на сайт WIRALIS</b>\n\n"
-            f"🔑 Ваш код: <code>{code}</code>\n\n"
-            f"⏰ Действителен до: {expires_text}\n\n"
-            f"📝 Инструкция:\n"
-            f"1. Перейдите на сайт WIRALIS\n"
-            f"2. Нажмите кнопку 'Жду Сайт'\n"
-            f"3. Введите код выше\n"
-            f"4. Наслаждайтесь своим профилем!\n\n"
-            f"💡 Код можно использовать только один раз."
-        )
-
-        keyboard = [
-            [InlineKeyboardButton("🌐 Открыть сайт", url=WEBSITE_URL)],
-            [InlineKeyboardButton("🔄 Новый код", callback_data="web_regenerate")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        await query.edit_message_text(
-            message,
-            parse_mode='HTML',
-            reply_markup=reply_markup
+        await _deliver_code(
+            query.edit_message_text, user, "Новый код для входа на сайт WIRALIS"
         )
 
     except Exception as e:
-        logger.error(f"Error in web_regenerate_callback: {e}", exc_info=True)
+        logger.error("Error in web_regenerate_callback: %s", e, exc_info=True)
         await query.edit_message_text(
             "❌ Произошла ошибка при обработке запроса.\n"
             "Попробуйте позже."
         )
 
 
-def setup(application):
+# Обработчики создаются один раз при импорте модуля
+_HANDLERS = (
+    CommandHandler("web", web_command),
+    CallbackQueryHandler(web_regenerate_callback, pattern=_WEB_REGENERATE_RE),
+)
+
+# Команды модуля для статистики и помощи
+_COMMANDS = ("web",)
+
+
+def setup(core):
     """
     Регистрирует обработчики модуля.
     Эта функция вызывается ядром бота при загрузке модуля.
+    Она должна вернуть обработчики, а не регистрировать их.
     """
-    # Регистрируем команду /web
-    application.add_handler(CommandHandler("web", web_command))
-    
-    # Регистрируем обработчик кнопки регенерации кода
-    application.add_handler(CallbackQueryHandler(web_regenerate_callback, pattern="^web_regenerate$"))
-    
-    logger.info("Модуль веб-интеграции загружен успешно")
+    # Без секрета сайт отклонит любой запрос — не загружаем модуль вовсе
+    if not API_SECRET:
+        raise RuntimeError("TELEGRAM_BOT_API_SECRET environment variable is not set!")
+
+    logger.info("Модуль веб-интеграции подготовлен к загрузке")
     
-    return [
-        CommandHandler("web", web_command),
-        CallbackQueryHandler(web_regenerate_callback, pattern="^web_regenerate$")
-    ]
+    # Возвращаем кортеж (handlers, commands), как того ожидает ядро
+    return _HANDLERS, _COMMANDS
 
 
 def cleanup():
     """
     Очистка ресурсов при выгрузке модуля (опционально).
     """
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        try:
+            # asyncio хранит задачи по слабым ссылкам — держим свою до завершения
+            task = asyncio.get_running_loop().create_task(_SESSION.close())
+            _BACKGROUND_TASKS.add(task)
+            task.add_done_callback(_BACKGROUND_TASKS.discard)
+        except RuntimeError:
+            # Цикл событий уже остановлен — соединения закроются вместе с процессом
+            pass
+    _SESSION = None
     logger.info("Модуль веб-интеграции выгружен")